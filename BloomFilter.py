@@ -2,6 +2,7 @@
 # See https://creativecommons.org/licenses/by-nc/4.0/
 
 import adsk.core, adsk.fusion, traceback
+import functools
 import hashlib
 
 default_category_name = 'Fruit'
@@ -35,40 +36,72 @@ num_hashes = 10
 _app = None
 _ui = None
 _handlers = []
+_command_created_handler = None
 
 #
 # Bloom filter utils
 #
 
-def create_bloom_filter(entries):
+def create_bloom_filter(entries) -> int:
     """
     Create a toy bloom filter containing the given entries.
+    The filter is a 256-bit bitmap where bit b is set iff some entry
+    hashes to byte b.
     """
-    bloom = set()
+    bloom = 0
     for item in entries:
-        add_to_bloom_filter(item, bloom)
+        bloom = add_to_bloom_filter(item, bloom)
     return bloom
 
-def item_in_bloom(item: str, bloom) -> bool:
-    item_hash = create_bloom_filter([item])
-    return item_hash & bloom == item_hash
+def item_in_bloom(item: str, bloom: int) -> bool:
+    # Test the hash bytes directly, stopping at the first miss
+    return all((bloom >> b) & 1 for b in sparse_hash(item))
 
-def add_to_bloom_filter(string_to_add: str, bloom):
+def add_to_bloom_filter(string_to_add: str, bloom: int = 0) -> int:
     """
-    Add to a toy bloom filter. In a real bloom filter, we'd use
-    a bitmap rather than a set of numbers, since the whole point is to be
-    memory efficient.
+    Add to a toy bloom filter, returning the new bitmap.
     """
-    global num_hashes
-    encoded_string = string_to_add.encode('utf-8')
+    return bloom | item_mask(string_to_add)
+
+# The bitmap bit for each byte value
+_byte_bits = tuple(1 << b for b in range(256))
+
+@functools.lru_cache(maxsize=None)
+def item_mask(item: str) -> int:
+    """
+    The bitmap for a single item. It is computed once while the filter
+    is built, so drawing the item's card afterwards is a cache hit.
+    """
+    mask = 0
+    for b in sparse_hash(item):
+        mask |= _byte_bits[b]
+    return mask
+
+def bytes_in_bloom(bloom: int):
+    """
+    The bytes whose bits are set in the bloom, in ascending order.
+    Visits only the set bits rather than all 256.
+    """
+    while bloom:
+        low_bit = bloom & -bloom
+        yield low_bit.bit_length() - 1
+        bloom ^= low_bit
+
+# num_hashes frozen when the module loads, so the item_mask cache
+# can't disagree with later calls
+_num_hashes = num_hashes
+
+def sparse_hash(item: str) -> bytes:
+    """
+    The num_hashes 1-byte hashes for an item.
+    """
+    # str.encode() defaults to UTF-8, which skips normalizing an encoding name
+    encoded_string = item.encode()
 
     # A Bloom filter generates multiple hashes per item.
     # Since all bits are equally probable in a high-quality hash,
     # we can slice up a 265-bit hash into up to 32 1-byte hashes.
-    sha256_hash = hashlib.sha256(encoded_string).digest()
-
-    for i in range(num_hashes):
-        bloom.add(sha256_hash[i])
+    return hashlib.sha256(encoded_string).digest()[:_num_hashes]
 
 
 def coordinates_from_byte(b):
@@ -103,7 +136,8 @@ class BloomCommandExecuteHandler(adsk.core.CommandEventHandler):
             design = _app.activeProduct
             component = design.activeComponent
 
-            items = [s.strip() for s in items_str.split('\n')]
+            # splitlines() also handles Windows line endings; skip blank lines
+            items = [s for s in (line.strip() for line in items_str.splitlines()) if s]
             bloom = create_bloom_filter(items)
 
             draw_bloom_component(bloom, name, component)
@@ -148,9 +182,17 @@ class BloomCommandDestroyHandler(adsk.core.CommandEventHandler):
     def __init__(self):
         super().__init__()
     def notify(self, args):
+        global _command_created_handler
         try:
+            # The command definition outlives the script, so detach our
+            # handler from it; otherwise every run leaves one attached
+            cmdDef = _ui.commandDefinitions.itemById('BloomCmd')
+            if cmdDef and _command_created_handler:
+                cmdDef.commandCreated.remove(_command_created_handler)
+            _command_created_handler = None
+
             # when the command is done, terminate the script
-            # this will release all globals which will remove all event handlers
+            # this will release all globals, including the handlers for this command
             adsk.terminate()
         except:
             if _ui:
@@ -161,6 +203,51 @@ class BloomCommandDestroyHandler(adsk.core.CommandEventHandler):
 # Sketch commands
 #
 
+# Pixel corner points keyed by (point_tolerance, byte), since they only
+# depend on the grid constants
+_pixel_corners = {}
+
+def pixel_corners(byte: int, point_tolerance: float):
+    """
+    The (p1, p2) rectangle corners of the pixel for a byte, shrunk on
+    each side by point_tolerance.
+    """
+    key = (point_tolerance, byte)
+    corners = _pixel_corners.get(key)
+    if corners is None:
+        point = adsk.core.Point3D.create
+        full_point_size = pixel_size + grid_spacing
+        grid_x, grid_y = coordinates_from_byte(byte)
+        block_x = grid_x * full_point_size
+        block_y = grid_y * full_point_size
+
+        p1_offset = grid_spacing + point_tolerance
+        p1 = point(block_x + p1_offset, block_y + p1_offset, 0)
+
+        p2_offset = grid_spacing + pixel_size - point_tolerance
+        p2 = point(block_x + p2_offset, block_y + p2_offset, 0)
+        corners = p1, p2
+        _pixel_corners[key] = corners
+    return corners
+
+def draw_pixels(bloom: int, sketch, point_tolerance: float):
+    """
+    Draw a rectangle for each pixel set in the bloom.
+    Fusion has no bulk rectangle call, so instead we defer the sketch
+    solve until all the rectangles have been added.
+    """
+    # Bind the per-pixel lookups to locals outside the loop
+    add_rectangle = sketch.sketchCurves.sketchLines.addTwoPointRectangle
+    corners = pixel_corners
+    sketch.isComputeDeferred = True
+    try:
+        # Only visit the set pixels rather than scanning all 256
+        for byte in bytes_in_bloom(bloom):
+            p1, p2 = corners(byte, point_tolerance)
+            add_rectangle(p1, p2)
+    finally:
+        sketch.isComputeDeferred = False
+
 def draw_bloom_component(bloom, name, parent_component):
     global grid_spacing, pixel_size, grid_size, grid_margin, pixel_height
     occurrence = parent_component.occurrences.addNewComponent(adsk.core.Matrix3D.create())
@@ -180,33 +267,19 @@ def draw_bloom_grid(bloom, component, sketch):
     Draw Bloom sketch and boxes. This must be done in a sketch with no other profiles.
     """
     global grid_spacing, pixel_size, grid_size, grid_margin, pixel_height, card_top_left, filter_card_bottom_right
+    point = adsk.core.Point3D.create
+    real_value = adsk.core.ValueInput.createByReal
 
-    point_tolerance = 0.0
-    full_point_size = pixel_size + grid_spacing
-
+    draw_pixels(bloom, sketch, 0.0)
     lines = sketch.sketchCurves.sketchLines
 
-    for grid_x in range(16):
-        for grid_y in range(16):
-            byte = byte_for_coordinate(grid_x, grid_y)
-            if byte in bloom:
-                block_x = grid_x * full_point_size
-                block_y = grid_y * full_point_size
-
-                p1_offset = grid_spacing + point_tolerance
-                p1 = adsk.core.Point3D.create(block_x + p1_offset, block_y + p1_offset, 0)
-
-                p2_offset = grid_spacing + pixel_size - point_tolerance
-                p2 = adsk.core.Point3D.create(block_x + p2_offset, block_y + p2_offset, 0)
-                lines.addTwoPointRectangle(p1, p2)
-
     # Draw outline and extrude
     lines.addTwoPointRectangle(
-        adsk.core.Point3D.create(card_top_left[0], card_top_left[1], 0),
-        adsk.core.Point3D.create(filter_card_bottom_right[0], filter_card_bottom_right[1], 0))
+        point(card_top_left[0], card_top_left[1], 0),
+        point(filter_card_bottom_right[0], filter_card_bottom_right[1], 0))
     extrudes = component.features.extrudeFeatures
     extrudes.addSimple(sketch.profiles.item(sketch.profiles.count - 1),
-                       adsk.core.ValueInput.createByReal(pixel_height),
+                       real_value(pixel_height),
                        adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
 
 def draw_hash_item(item: str, height_cm: float, parent_component):
@@ -228,37 +301,23 @@ def draw_hash_item(item: str, height_cm: float, parent_component):
 def draw_hash_sketches(item: str, component, plane):
     global grid_spacing, pixel_size, grid_size, grid_margin, pixel_height, card_top_left
     global item_card_bottom_right, tolerance
-
-    full_point_size = pixel_size + grid_spacing
+    point = adsk.core.Point3D.create
+    real_value = adsk.core.ValueInput.createByReal
 
     sketches = component.sketches
     sketch1 = sketches.add(plane)
-    lines = sketch1.sketchCurves.sketchLines
-
-    item_hash = create_bloom_filter([item])
-
-    for grid_x in range(16):
-        for grid_y in range(16):
-            byte = byte_for_coordinate(grid_x, grid_y)
-            if byte in item_hash:
-                block_x = grid_x * full_point_size
-                block_y = grid_y * full_point_size
-
-                p1_offset = grid_spacing + tolerance
-                p1 = adsk.core.Point3D.create(block_x + p1_offset, block_y + p1_offset, 0)
 
-                p2_offset = grid_spacing + pixel_size - tolerance
-                p2 = adsk.core.Point3D.create(block_x + p2_offset, block_y + p2_offset, 0)
-                lines.addTwoPointRectangle(p1, p2)
+    item_hash = item_mask(item)
+    draw_pixels(item_hash, sketch1, tolerance)
 
     # Extrude all profiles. It's too hard to determine which ones we want, hence doing this in a fresh sketch
 
-    profiles_to_extrude1 = adsk.core.ObjectCollection.create()
-    for prof_index in range(sketch1.profiles.count):
-        profiles_to_extrude1.add(sketch1.profiles.item(prof_index))
+    profiles = sketch1.profiles
+    profiles_to_extrude1 = adsk.core.ObjectCollection.createWithArray(
+        [profiles.item(prof_index) for prof_index in range(profiles.count)])
     extrudes = component.features.extrudeFeatures
     extrudes.addSimple(profiles_to_extrude1,
-                       adsk.core.ValueInput.createByReal(-pixel_height),  # Negative to point toward filter
+                       real_value(-pixel_height),  # Negative to point toward filter
                        adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
 
     # Draw a containing rectangle and extrude it in its own sketch in order to ignore the interior profiles
@@ -266,11 +325,11 @@ def draw_hash_sketches(item: str, component, plane):
     sketch2 = sketches.add(plane)
     lines2 = sketch2.sketchCurves.sketchLines
     lines2.addTwoPointRectangle(
-        adsk.core.Point3D.create(card_top_left[0], card_top_left[1], 0),
-        adsk.core.Point3D.create(item_card_bottom_right[0], item_card_bottom_right[1], 0))
+        point(card_top_left[0], card_top_left[1], 0),
+        point(item_card_bottom_right[0], item_card_bottom_right[1], 0))
 
     extrudes.addSimple(sketch2.profiles.item(0),
-                       adsk.core.ValueInput.createByReal(card_base_thickness), # Positive to preserve hash extrude length
+                       real_value(card_base_thickness), # Positive to preserve hash extrude length
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
 
     return [sketch1, sketch2]
@@ -278,6 +337,8 @@ def draw_hash_sketches(item: str, component, plane):
 def draw_item_text(name: str, component, plane):
     global grid_spacing, pixel_size, grid_size, grid_margin, pixel_height, tolerance
     global card_top_left, item_card_bottom_right, filter_card_bottom_right
+    point = adsk.core.Point3D.create
+    real_value = adsk.core.ValueInput.createByReal
 
     plate_extrude_distance = pixel_height + (0.1 * mm) # use tighter tolerance for good looks
 
@@ -291,11 +352,11 @@ def draw_item_text(name: str, component, plane):
     lines = sketch.sketchCurves.sketchLines
     plate_top_y =  filter_card_bottom_right[1] - tolerance
 
-    p1 = adsk.core.Point3D.create(card_top_left[0], plate_top_y, 0)
-    p2 = adsk.core.Point3D.create(item_card_bottom_right[0], item_card_bottom_right[1], 0)
+    p1 = point(card_top_left[0], plate_top_y, 0)
+    p2 = point(item_card_bottom_right[0], item_card_bottom_right[1], 0)
     lines.addTwoPointRectangle(p1, p2)
     extrudes.addSimple(sketch.profiles.item(0),
-                       adsk.core.ValueInput.createByReal(-plate_extrude_distance),
+                       real_value(-plate_extrude_distance),
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
 
     # Create & extrude the text
@@ -312,8 +373,8 @@ def draw_item_text(name: str, component, plane):
     start = - side_padding_cm - grid_margin
     end = grid_size + grid_margin - side_padding_cm
 
-    name_text_p1 = adsk.core.Point3D.create(start, baseline1, 0)
-    name_text_p2 = adsk.core.Point3D.create(end, top1, 0)
+    name_text_p1 = point(start, baseline1, 0)
+    name_text_p2 = point(end, top1, 0)
     name_text_input = sketch_texts.createInput2(name, text_height_cm)
     name_text_input.setAsMultiLine(name_text_p1,  # corner
                               name_text_p2,  # diagonal
@@ -324,8 +385,8 @@ def draw_item_text(name: str, component, plane):
     name_text_input.textStyle = adsk.fusion.TextStyles.TextStyleBold
     name_text_obj = sketch_texts.add(name_text_input)
 
-    info_text_p1 = adsk.core.Point3D.create(start, baseline2, 0)
-    info_text_p2 = adsk.core.Point3D.create(end, top2, 0)
+    info_text_p1 = point(start, baseline2, 0)
+    info_text_p2 = point(end, top2, 0)
     info_text_input = sketch_texts.createInput2("github.com/\ndleppik/\nFusionBloomFilter", 0.5)
     info_text_input.setAsMultiLine(info_text_p1,  # corner
                                    info_text_p2,  # diagonal
@@ -337,15 +398,17 @@ def draw_item_text(name: str, component, plane):
     info_text_obj = sketch_texts.add(info_text_input)
 
     extrudes.addSimple(name_text_obj,
-                       adsk.core.ValueInput.createByReal(-1 * mm - plate_extrude_distance),
+                       real_value(-1 * mm - plate_extrude_distance),
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
 
     extrudes.addSimple(info_text_obj,
-                       adsk.core.ValueInput.createByReal(-1 * mm - plate_extrude_distance),
+                       real_value(-1 * mm - plate_extrude_distance),
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
 
 def draw_bloom_text(name: str, component, plane):
     global grid_spacing, pixel_size, grid_size, grid_margin, pixel_height
+    point = adsk.core.Point3D.create
+    real_value = adsk.core.ValueInput.createByReal
 
     sketches = component.sketches
     sketch = sketches.add(plane)
@@ -367,10 +430,10 @@ def draw_bloom_text(name: str, component, plane):
     line_1_start = line_2_end + font_descent_cm
     line_2_end = line_1_start + text_height_cm
     
-    line_2_p1 = adsk.core.Point3D.create(start, line_2_start + font_descent_cm, 0)
-    line_2_p2 = adsk.core.Point3D.create(end, line_2_end, 0)
-    line_1_p1 = adsk.core.Point3D.create(start, line_1_start + font_descent_cm, 0)
-    line_1_p2 = adsk.core.Point3D.create(end, line_2_end, 0)
+    line_2_p1 = point(start, line_2_start + font_descent_cm, 0)
+    line_2_p2 = point(end, line_2_end, 0)
+    line_1_p1 = point(start, line_1_start + font_descent_cm, 0)
+    line_1_p2 = point(end, line_2_end, 0)
 
     description_input = sketch_texts.createInput2("Bloom Filter", secondary_text_height_cm)
     description_input.setAsMultiLine(line_1_p1,  # corner
@@ -394,10 +457,10 @@ def draw_bloom_text(name: str, component, plane):
 
     extrudes = component.features.extrudeFeatures
     extrudes.addSimple(name_text,
-                       adsk.core.ValueInput.createByReal(-1 * mm),
+                       real_value(-1 * mm),
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
     extrudes.addSimple(description_text,
-                       adsk.core.ValueInput.createByReal(-1 * mm),
+                       real_value(-1 * mm),
                        adsk.fusion.FeatureOperations.JoinFeatureOperation)
 
 #
@@ -405,7 +468,7 @@ def draw_bloom_text(name: str, component, plane):
 #
 
 def run(context):
-    global _app, _ui
+    global _app, _ui, _command_created_handler
     try:
         # Get the application and design
         app = adsk.core.Application.get()
@@ -421,12 +484,12 @@ def run(context):
                                                             'Create Bloom Filter',
                                                             'Create a Bloom filter.')
 
-        on_command_created = BloomCommandCreatedHandler()
-        cmdDef.commandCreated.add(on_command_created)
+        # Kept in a global so the destroy handler can detach it from cmdDef
+        _command_created_handler = BloomCommandCreatedHandler()
+        cmdDef.commandCreated.add(_command_created_handler)
         # keep the handler referenced beyond this function
-        _handlers.append(on_command_created)
-        inputs = adsk.core.NamedValues.create()
-        cmdDef.execute(inputs)
+        _handlers.append(_command_created_handler)
+        cmdDef.execute()
 
         # prevent this module from being terminate when the script returns, because we are waiting for event handlers to fire
         adsk.autoTerminate(False)